@@ -2,14 +2,25 @@
 """
 Venv autouse common code.
 """
+# pylint: disable=[import-outside-toplevel]
+# import-outside-toplevel: this is imported by every script using it, only import the heavy modules when needed.
+
 import sys
-from os import environ
-import venv
+from os import environ, replace, scandir
+from os.path import basename
 from pathlib import Path
-from inspect import currentframe
 import hashlib
-from subprocess import run
-from platform import system
+import mmap
+from functools import lru_cache, partial
+
+
+DIGEST_CHUNK_SIZE = 1 << 16
+DIGEST_MMAP_THRESHOLD = 64 * 1024
+DIGEST_PARALLEL_THRESHOLD = 1 << 20
+
+# The digests only tell if a requirements file changed, they are not used for security
+DIGEST_SIZE = 32
+_new_hasher = partial(hashlib.blake2b, digest_size=DIGEST_SIZE, usedforsecurity=False)
 
 
 class VenvAutouseRuntimeError(RuntimeError):
@@ -27,6 +38,83 @@ if __name__ == '__main__':
     raise_if_main()
 
 
+@lru_cache(maxsize=32)
+def _digest_if_changed(filename: str, mtime_ns: int, size: int) -> str:
+    """
+    Digest a file.
+
+    The modification time is not used here, it is part of the cache key.
+    Big files are mapped in memory to be hashed without copying them.
+    """
+    if size > DIGEST_MMAP_THRESHOLD:
+        with open(filename, 'rb') as file_obj, mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _new_hasher(mapped).hexdigest()
+
+    with open(filename, 'rb', buffering=0) as file_obj:
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(file_obj, _new_hasher).hexdigest()
+
+        # Python 3.10: no file_digest, feed the hash by chunks
+        hasher = _new_hasher()
+        while chunk := file_obj.read(DIGEST_CHUNK_SIZE):
+            hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+
+def _read_hash_file_lines(filename: Path) -> list[str]:
+    """
+    Read the lines of a custom hash file ([] if it does not exist).
+    """
+    try:
+        data = filename.read_bytes()
+    except FileNotFoundError:
+        return []
+
+    return data.decode().splitlines()
+
+
+@lru_cache(maxsize=32)
+def _parse_hash_file_cached(filename: str, mtime_ns: int, size: int) -> tuple[tuple[str, str], ...]:
+    """
+    Parse a custom hash file.
+
+    The modification time and size are not used here, they are part of the cache key.
+    """
+    return tuple(
+        (key, value)
+        for line in _read_hash_file_lines(Path(filename))
+        if line.strip()
+        for key, _, value in [line.strip().partition(':')]
+    )
+
+
+@lru_cache(maxsize=8)
+def _venv_exe_cached(venv_dir: Path, is_windows: bool) -> Path:
+    """
+    Get the venv executable for the given venv dir and platform.
+    """
+    bin_dir = 'bin'
+    exe = 'python'
+
+    if is_windows:
+        bin_dir = 'Scripts'
+        exe = 'python.exe'
+
+    return venv_dir / bin_dir / exe
+
+
+def _listdir_set(directory: Path) -> set[str]:
+    """
+    Get the names of the entries of a directory (empty if it does not exist).
+    """
+    try:
+        with scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
 class VenvAutouse:
     """
     Venv autouse executer.
@@ -34,7 +122,7 @@ class VenvAutouse:
     PACKAGE_NAME = 'venv_autouse'
     ENV_VAR_PREVENT_RECURSION = f'PYTHON_{PACKAGE_NAME.upper()}_SUBPROCESS'
 
-    IS_WINDOWS = system().lower() == 'windows'
+    IS_WINDOWS = sys.platform == 'win32'
 
     VENV_DIR_PREFIX: str | None = None
 
@@ -44,10 +132,7 @@ class VenvAutouse:
         self.dir_req_filename = self.filename.parent / 'requirements.txt'
         self.file_req_filename = self.filename.with_suffix('.req.txt')
 
-        self.req_files: dict[Path, str] = {
-            filename: self.digest_file(filename)
-            for filename in [self.dir_req_filename, self.file_req_filename]
-        }
+        self.req_files: dict[Path, str] = self.digest_files([self.dir_req_filename, self.file_req_filename])
 
         venv_dir_prefix = f'.{self.filename.with_suffix("").name}'
         if self.VENV_DIR_PREFIX is not None:
@@ -71,7 +156,7 @@ class VenvAutouse:
         """
         parents = []
 
-        parent_caller = currentframe()
+        parent_caller = sys._getframe()  # pylint: disable=[protected-access]
         while parent_caller is not None:
             parent_filename = self.get_filename_from_caller(parent_caller)
 
@@ -85,14 +170,15 @@ class VenvAutouse:
                 # ignore if we find a python internal frame
                 continue
 
-            if Path(parent_filename).name == 'runpy.py':
+            if basename(parent_filename) == 'runpy.py':
                 # ignore if command was "python -m"
                 continue
 
             parents.append(parent_filename)
 
         if len(parents) == 0:
-            raise VenvAutouseRuntimeError(f'Unable to determine parent caller for {currentframe()}')
+            current_frame = sys._getframe()  # pylint: disable=[protected-access]
+            raise VenvAutouseRuntimeError(f'Unable to determine parent caller for {current_frame}')
 
         filename = Path(parents[-1])
 
@@ -105,53 +191,113 @@ class VenvAutouse:
     def digest_file(file: Path) -> str:
         """
         Digest a file.
+
+        The digest is cached as long as the file modification time and size do not change.
         """
-        if not file.exists():
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
             return ''
 
-        return hashlib.sha3_256(file.read_bytes()).hexdigest()
+        return _digest_if_changed(str(file), stat.st_mtime_ns, stat.st_size)
 
-    def venv_get_exe(self) -> Path:
+    @staticmethod
+    def digest_files(files: list[Path]) -> dict[Path, str]:
         """
-        Get the venv executable (depends on the platform).
+        Digest several files.
+
+        Hashing releases the GIL, so big files are digested in parallel threads.
+        Small files are not worth starting threads.
         """
-        bin_dir = 'bin'
-        exe = 'python'
+        # Stat only once, the stat is also the cache key of the digest
+        stats = {}
+        for file in files:
+            try:
+                stats[file] = file.stat()
+            except FileNotFoundError:
+                pass
+
+        digests = {file: '' for file in files}
+
+        total_size = sum(stat.st_size for stat in stats.values())
+        if len(stats) < 2 or total_size <= DIGEST_PARALLEL_THRESHOLD:
+            for file, stat in stats.items():
+                digests[file] = _digest_if_changed(str(file), stat.st_mtime_ns, stat.st_size)
+
+            return digests
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=len(stats)) as executor:
+            futures = {
+                file: executor.submit(_digest_if_changed, str(file), stat.st_mtime_ns, stat.st_size)
+                for file, stat in stats.items()
+            }
 
-        if self.IS_WINDOWS:
-            bin_dir = 'Scripts'
-            exe = 'python.exe'
+            for file, future in futures.items():
+                digests[file] = future.result()
 
-        return self.venv_dir / bin_dir / exe
+        return digests
+
+    def venv_get_exe(self) -> Path:
+        """
+        Get the venv executable (depends on the platform).
+
+        The path is cached as long as the venv dir and the platform do not change.
+        """
+        return _venv_exe_cached(self.venv_dir, self.IS_WINDOWS)
 
     def venv_hash_readlines(self) -> list[str]:
         """
         Read the custom hash file we use in the venv dir.
         """
-        if not self.venv_hash_file.exists():
-            return []
-
-        return self.venv_hash_file.read_text().splitlines()
+        return _read_hash_file_lines(self.venv_hash_file)
 
     def venv_hash_parse(self) -> dict:
         """
         Parse the custom hash file we use in the venv dir.
+
+        The parsing is cached as long as the file modification time and size do not change.
         """
-        contents = self.venv_hash_readlines()
-        if contents == []:
+        try:
+            stat = self.venv_hash_file.stat()
+        except FileNotFoundError:
             return {}
 
-        checks: dict[str, str] = {}
-        for line in contents:
-            key, value = line.strip().split(':', 1)
-            checks[key] = value
+        # Copy so the cached entries are not modified when we update the hashes
+        return dict(_parse_hash_file_cached(str(self.venv_hash_file), stat.st_mtime_ns, stat.st_size))
+
+    def venv_hash_write(self) -> None:
+        """
+        Write the custom hash file we use in the venv dir, only if it changed.
+
+        The file is replaced atomically so it is never seen half written.
+        Each writer uses its own temporary file, several scripts may share the same venv.
+        """
+        from tempfile import mkstemp
+
+        hashes = {key: value for key, value in self.venv_hash.items() if value is not None}
+        if hashes == self.venv_hash_parse():
+            return
 
-        return checks
+        fd, tmp_file = mkstemp(dir=self.venv_hash_file.parent, prefix=f'{self.venv_hash_file.name}.', suffix='.tmp')
+        replaced = False
+        try:
+            with open(fd, 'wb') as file_obj:
+                file_obj.write('\n'.join(f'{key}:{value}' for key, value in hashes.items()).encode())
+
+            replace(tmp_file, self.venv_hash_file)
+            replaced = True
+        finally:
+            if not replaced:
+                Path(tmp_file).unlink(missing_ok=True)
 
     def run_pip_install(self, cmd_args: list) -> None:
         """
         Run a pip command (subprocess) to install.
         """
+        from subprocess import run
+
         run([str(self.venv_get_exe()), '-m', 'pip', 'install'] + cmd_args, check=True)
 
     def venv_create(self) -> None:
@@ -161,57 +307,84 @@ class VenvAutouse:
         if self.venv_dir.exists():
             return
 
+        import venv
+
         venv.create(self.venv_dir, with_pip=True)
 
     def venv_hash_check(self, req_file: Path) -> bool:
         """
         Check if the hash of the requirements file match.
         """
-        if req_file.name not in self.venv_hash:
+        stored = self.venv_hash.get(req_file.name)
+        if not stored:
             return False
 
+        return stored == self.req_file_digest(req_file)
+
+    def req_file_digest(self, req_file: Path) -> str:
+        """
+        Get the digest of a requirements file ('' if it does not exist).
+
+        The digests computed when starting are reused, this also tells if the file exists without checking again.
+        """
         if req_file not in self.req_files:
             # Should not happen but better be safe
             self.req_files[req_file] = self.digest_file(req_file)
 
-        return self.venv_hash[req_file.name] == self.req_files[req_file]
+        return self.req_files[req_file]
 
     def run_pip_install_file(self, filename: Path) -> None:
         """
         Run a pip command (subprocess) to install from a requirements file.
         """
-        self.run_pip_install(['-r', str(filename)])
+        self.run_pip_install_files([filename])
 
-    def venv_install_self(self) -> None:
+    def run_pip_install_files(self, filenames: list[Path], packages: list[Path] | None = None) -> None:
         """
-        Install this package in the venv.
+        Run a single pip command (subprocess) to install from several requirements files (and packages).
+        """
+        cmd_args: list = [str(package) for package in packages or []]
+        for filename in filenames:
+            cmd_args += ['-r', str(filename)]
 
-        We need this package in the venv too otherwise the import will fail.
+        self.run_pip_install(cmd_args)
+
+    def venv_find_self_package(self) -> list[Path]:
+        """
+        Find the downloaded packages of this package in the venv dir, in alphabetical order.
+        """
+        return [
+            self.venv_dir / name
+            for name in sorted(_listdir_set(self.venv_dir))
+            if name.startswith(self.PACKAGE_NAME)
+        ]
+
+    def venv_find_self_install(self) -> Path | None:
+        """
+        Get the package of this package to install in the venv (None if already installed).
+
+        It is downloaded if needed.
         """
-        package = list(self.venv_dir.glob(f'{self.PACKAGE_NAME}*'))
+        package = self.venv_find_self_package()
 
         if len(package) > 0:
             # Already downloaded
             # If more than one package, the latest one should be the last in alphabetical list.
-            venv_lib_py = list((self.venv_dir / 'lib').glob('python*'))
+            venv_lib = self.venv_dir / 'lib'
+            venv_lib_py = sorted(name for name in _listdir_set(venv_lib) if name.startswith('python'))
             if len(venv_lib_py) == 0:
                 # Should not happen but be safe
-                self.run_pip_install([str(package[-1])])
-                return
+                return package[-1]
 
-            dist_info = (
-                venv_lib_py[0]
-                / 'site-packages'
-                / package[-1].name.replace('-py3-none-any.whl', '.dist-info')
-            )
+            dist_info = package[-1].name.replace('-py3-none-any.whl', '.dist-info')
 
-            if dist_info.exists():
+            if dist_info in _listdir_set(venv_lib / venv_lib_py[0] / 'site-packages'):
                 # Already installed
-                return
+                return None
 
-            # install
-            self.run_pip_install([str(package[-1])])
-            return
+            return package[-1]
+
+        from subprocess import run
 
         download = run(
             [str(self.venv_get_exe()), '-m', 'pip', 'download', self.PACKAGE_NAME],
@@ -220,35 +393,57 @@ class VenvAutouse:
             timeout=3,
         )
 
-        package = list(self.venv_dir.glob(f'{self.PACKAGE_NAME}*'))
+        package = self.venv_find_self_package()
         print(f'{package=} {self.venv_dir=}')
         if download.returncode != 0 or len(package) == 0:
             # Something bad happened
             raise VenvAutouseRuntimeError(f'Failed to install self ({download.returncode})')
 
         # If we match more than one package, the latest one should be the last in alphabetical list.
-        self.run_pip_install([str(package[-1])])
+        return package[-1]
+
+    def venv_install_self(self) -> None:
+        """
+        Install this package in the venv.
+
+        We need this package in the venv too otherwise the import will fail.
+        """
+        package = self.venv_find_self_install()
+        if package is None:
+            return
+
+        self.run_pip_install([str(package)])
 
     def venv_apply_req_file(self, req_file: Path) -> bool:
         """
         Install requirements file with pip.
         """
-        if not req_file.exists():
-            return False
+        return self.venv_apply_req_files([req_file])
+
+    def venv_apply_req_files(self, req_files: list[Path], packages: list[Path] | None = None) -> bool:
+        """
+        Install the requirements files which changed with a single pip call.
+
+        The packages are installed in the same pip call.
 
-        if self.venv_hash_check(req_file):
+        Returns:
+            bool: True if some file was installed, False if none changed
+        """
+        changed = [
+            req_file
+            for req_file in req_files
+            if self.req_file_digest(req_file) != '' and not self.venv_hash_check(req_file)
+        ]
+        if len(changed) == 0 and not packages:
             return False
 
-        self.run_pip_install_file(req_file)
+        self.run_pip_install_files(changed, packages)
 
-        # update hash
-        if req_file in self.req_files:
-            # Already computed
-            self.venv_hash[req_file.name] = self.req_files[req_file]
-        else:
-            self.venv_hash[req_file.name] = self.digest_file(req_file)
+        # update hashes
+        for req_file in changed:
+            self.venv_hash[req_file.name] = self.req_file_digest(req_file)
 
-        return True
+        return len(changed) > 0
 
     def venv_update(self) -> bool:
         """
@@ -259,17 +454,14 @@ class VenvAutouse:
         """
         self.venv_create()
 
-        self.venv_install_self()
+        # Install this package with the requirements files, to start pip only once
+        self_package = self.venv_find_self_install()
+        packages = [] if self_package is None else [self_package]
 
-        dir_req_file_updated = self.venv_apply_req_file(self.dir_req_filename)
-        file_req_file_updated = self.venv_apply_req_file(self.file_req_filename)
-
-        if not dir_req_file_updated and not file_req_file_updated:
+        if not self.venv_apply_req_files([self.dir_req_filename, self.file_req_filename], packages):
             return False
 
-        # write hash file
-        hashes = [f'{key}:{value}' for key, value in self.venv_hash.items() if value is not None]
-        self.venv_hash_file.write_text('\n'.join(hashes))
+        self.venv_hash_write()
 
         return True
 
@@ -298,5 +490,7 @@ class VenvAutouse:
         # subprocess and exit (do not return to caller)
         env_vars = dict(environ)
         env_vars[self.ENV_VAR_PREVENT_RECURSION] = '1'
+        from subprocess import run
+
         process = run([str(self.venv_get_exe())] + sys.argv, check=False, env=env_vars)
         sys.exit(process.returncode)
@@ -7,13 +7,21 @@ Tests for "common.py".
 # redefined-outer-name: we can define a fixture and use it as arg to functions (pytest feature).
 # unused-argument: we need to use fake_process to register unwanted processes
 
-from inspect import currentframe
+# The fs fixture (pyfakefs) must come after venvauto in the test arguments,
+# the instance needs the real file system to be built and the background deletions must be done.
+
 from pathlib import Path
 from shutil import rmtree
-from subprocess import run
+import runpy
 import sys
-from os import environ
+from os import environ, replace
 from collections.abc import Generator
+from types import SimpleNamespace
+from functools import cache
+from copy import copy
+from threading import Thread
+from uuid import uuid4
+import hashlib
 
 # pylint: disable=[import-error]
 import pytest  # type: ignore
@@ -22,13 +30,41 @@ import pytest  # type: ignore
 from src.venv_autouse import common  # noqa: E402
 
 
-TEST_DIR = Path(__file__).parent
+def reference_digest(data: bytes) -> str:
+    """ Digest computed independently of the code under test. """
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+@cache
+def paths() -> SimpleNamespace:
+    """
+    Get the paths (and reference digests) used by the tests, computed only once on first use.
+
+    The first use is the session fixture, on the real file system.
+    """
+    test_dir = Path(__file__).parent
+
+    sample_req_file = test_dir / 'sample_req.txt'
+    sample_req_file2 = test_dir / 'sample_req2.txt'
+
+    return SimpleNamespace(
+        foo_file=test_dir / 'foo',
+        sample_req_file=sample_req_file,
+        sample_req_file2=sample_req_file2,
+        sample_hash_file=test_dir / 'sample_hash_file.txt',
+        sample_req_file_hash=reference_digest(sample_req_file.read_bytes()),
+        sample_req_file2_hash=reference_digest(sample_req_file2.read_bytes()),
+    )
 
-FOO_FILE = TEST_DIR / Path('foo')
-SAMPLE_REQ_FILE = TEST_DIR / 'sample_req.txt'
-SAMPLE_REQ_FILE_HASH = 'f7e270c8a03ff7dc90ff31aec88380e708deddc4ac91d5dbe7e64363ecdbeed7'
-SAMPLE_REQ_FILE2 = TEST_DIR / 'sample_req2.txt'
-SAMPLE_HASH_FILE = TEST_DIR / 'sample_hash_file.txt'
+
+# venv runs ensurepip in isolated mode before python 3.10
+ENSUREPIP_M_FLAG = '-Im' if sys.version_info < (3, 10) else '-m'
+
+PIP_INSTALL_PREFIX = ('-m', 'pip', 'install')
+PIP_DOWNLOAD_PREFIX = ('-m', 'pip', 'download')
+ENSUREPIP_ARGS = (ENSUREPIP_M_FLAG, 'ensurepip', '--upgrade', '--default-pip')
+
+TRASH_THREADS: list[Thread] = []
 
 
 def touch(file: Path) -> None:
@@ -37,78 +73,194 @@ def touch(file: Path) -> None:
     file.touch()
 
 
-@pytest.fixture
-def venvauto() -> Generator[common.VenvAutouse, None, None]:
+def trash(directory: Path) -> None:
     """
-    Test fixture to get a venv autouse instance and do the cleanup after.
+    Move a directory out of the way and delete it in the background.
+
+    Empty directories are removed right away, this is cheaper than a tree walk.
     """
+    try:
+        directory.rmdir()
+        return
+    except FileNotFoundError:
+        return
+    except OSError:
+        # Not empty
+        pass
+
+    trash_dir = directory.with_name(f'{directory.name}.trash.{uuid4().hex}')
+
+    try:
+        replace(directory, trash_dir)
+    except FileNotFoundError:
+        return
+
+    thread = Thread(target=rmtree, args=(trash_dir,), kwargs={'ignore_errors': True}, daemon=True)
+    thread.start()
+    TRASH_THREADS.append(thread)
+
+
+def join_trash_threads() -> None:
+    """ Wait for all the background deletions. """
+    while TRASH_THREADS:
+        TRASH_THREADS.pop().join()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def scratch_dir(tmp_path_factory) -> Generator[Path, None, None]:
+    """
+    Get the scratch dir, unique to this run and worker, and wait at the end of the session for the background deletions.
+    """
+    paths()  # first use, on the real file system
+
+    yield tmp_path_factory.mktemp('venv_dummy')
+
+    join_trash_threads()
+
 
-    # pylint: disable=[too-few-public-methods]
-    class TestVenvAutouse(common.VenvAutouse):
-        """ Just make a copy so we can change class constants. """
-        def __init__(self):
-            super().__init__()
+# pylint: disable=[too-few-public-methods]
+class TestVenvAutouse(common.VenvAutouse):
+    """ Just make a copy so we can change class constants. """
+    __test__ = False  # not a test class, do not let pytest collect it
 
-            venv_dir_prefix = f'.{self.filename.with_suffix("").name}'
-            if self.VENV_DIR_PREFIX is not None:
-                venv_dir_prefix = self.VENV_DIR_PREFIX
+    def __init__(self, scratch_dir: Path):
+        super().__init__()
 
-            self.venv_dir = TEST_DIR / f'venv_dummy.{venv_dir_prefix}.venv'
-            self.venv_dummy = self.venv_dir  # copy to keep it for tear down
+        venv_dir_prefix = f'.{self.filename.with_suffix("").name}'
+        if self.VENV_DIR_PREFIX is not None:
+            venv_dir_prefix = self.VENV_DIR_PREFIX
 
-            self.venv_hash_file = self.venv_dir / 'hash.req.txt'
-            self.venv_hash = self.venv_hash_parse()
+        self.venv_dir = scratch_dir / f'venv_dummy.{venv_dir_prefix}.venv'
+        self.venv_dummy = self.venv_dir  # copy to keep it for tear down
 
-            self.fake_package = self.venv_dir / self.PACKAGE_NAME
+        self.venv_hash_file = self.venv_dir / 'hash.req.txt'
+        self.venv_hash = self.venv_hash_parse()
 
-    venv_autouse_instance = TestVenvAutouse()
+        self.fake_package = self.venv_dir / self.PACKAGE_NAME
 
-    yield venv_autouse_instance
+
+@pytest.fixture(scope='session')
+def venvauto_proto(scratch_dir) -> TestVenvAutouse:
+    """
+    Test fixture to build the venv autouse instance only once for the session.
+    """
+    return TestVenvAutouse(scratch_dir)
+
+
+@pytest.fixture
+def venvauto(venvauto_proto, request) -> Generator[TestVenvAutouse, None, None]:
+    """
+    Test fixture to get a venv autouse instance and do the cleanup after.
+
+    The instance is shared, its state is restored after each test.
+    Its attributes are paths and dicts of strings, so only the dicts need to be copied,
+    they are then restored in place.
+    """
+    if 'fs' in request.fixturenames:
+        # pyfakefs patches os and shutil for the whole process, the background deletions must not see it
+        join_trash_threads()
+
+    state = dict(venvauto_proto.__dict__)
+    dicts = {name: (value, dict(value)) for name, value in state.items() if isinstance(value, dict)}
+
+    yield venvauto_proto
 
     # tear down
-    venv_autouse_instance.fake_package.unlink(missing_ok=True)
-    rmtree(venv_autouse_instance.venv_dummy, ignore_errors=True)
+    state['fake_package'].unlink(missing_ok=True)
+    trash(state['venv_dummy'])
+
+    venvauto_proto.__dict__.clear()
+    venvauto_proto.__dict__.update(state)
+    for orig, backup in dicts.values():
+        orig.clear()
+        orig.update(backup)
+
+    # Do not leak cached digests and parsed hash files to the next test
+    common._digest_if_changed.cache_clear()  # pylint: disable=[protected-access]
+    common._parse_hash_file_cached.cache_clear()  # pylint: disable=[protected-access]
 
 
 def test_execute_file() -> None:
     """ Test executing the file raises an exception. """
     root_dir = Path(__file__).resolve().parents[2]
     venv_autouse_file = root_dir / 'src' / 'venv_autouse' / 'common.py'
-    process = run([venv_autouse_file], check=False)
-    assert process.returncode != 0
+    with pytest.raises(RuntimeError):
+        runpy.run_path(str(venv_autouse_file), run_name='__main__')
 
 
 def test_get_filename_from_caller() -> None:
     """ get_filename_from_caller """
-    assert common.VenvAutouse.get_filename_from_caller(currentframe()) == __file__
+    frame = sys._getframe(0)  # pylint: disable=[protected-access]
+    assert common.VenvAutouse.get_filename_from_caller(frame) == __file__
 
 
+@pytest.mark.skipif('PYTEST_XDIST_WORKER' in environ, reason='pytest-xdist workers are not started by pytest')
 def test_get_caller_filename(venvauto) -> None:
     """ get_caller_filename """
     caller_filename = venvauto.get_caller_filename()
+
     assert caller_filename.name == '__main__.py'
     assert caller_filename.parts[-2] == 'pytest'
 
 
 def test_digest_file_nonexistent() -> None:
     """ digest_file with non-existent file """
-    assert common.VenvAutouse.digest_file(FOO_FILE) == ''
+    assert common.VenvAutouse.digest_file(paths().foo_file) == ''
 
 
 def test_digest_file_existing() -> None:
     """ digest_file with existing file"""
-    assert common.VenvAutouse.digest_file(SAMPLE_REQ_FILE) == SAMPLE_REQ_FILE_HASH
+    assert common.VenvAutouse.digest_file(paths().sample_req_file) == paths().sample_req_file_hash
+
+
+def test_digest_file_changed(venvauto) -> None:
+    """ digest_file of a file changed after a first digest """
+    req_file = venvauto.venv_dir / 'changed_req.txt'
+    touch(req_file)
+    req_file.write_bytes(paths().sample_req_file.read_bytes())
+    assert common.VenvAutouse.digest_file(req_file) == paths().sample_req_file_hash
+
+    req_file.write_bytes(paths().sample_req_file2.read_bytes())
+    assert common.VenvAutouse.digest_file(req_file) == paths().sample_req_file2_hash
+
+
+def test_digest_file_big(venvauto) -> None:
+    """ digest_file with a file big enough to be mapped in memory """
+    big_file = venvauto.venv_dir / 'big_req.txt'
+    touch(big_file)
+    contents = paths().sample_req_file.read_bytes()
+    big_file.write_bytes(contents * (common.DIGEST_MMAP_THRESHOLD // len(contents) + 1))
+
+    assert big_file.stat().st_size > common.DIGEST_MMAP_THRESHOLD
+    assert common.VenvAutouse.digest_file(big_file) == reference_digest(big_file.read_bytes())
+
+
+def test_digest_files(monkeypatch) -> None:
+    """ digest_files """
+    files = [paths().foo_file, paths().sample_req_file, paths().sample_req_file2]
+    expected = {
+        paths().foo_file: '',
+        paths().sample_req_file: paths().sample_req_file_hash,
+        paths().sample_req_file2: paths().sample_req_file2_hash,
+    }
 
+    assert common.VenvAutouse.digest_files(files) == expected
 
-def test_venv_get_exe_linux(venvauto) -> None:
+    # Same result with threads, hashing again instead of reading the cache
+    common._digest_if_changed.cache_clear()  # pylint: disable=[protected-access]
+    monkeypatch.setattr(common, 'DIGEST_PARALLEL_THRESHOLD', 0)
+    assert common.VenvAutouse.digest_files(files) == expected
+
+
+def test_venv_get_exe_linux(venvauto, monkeypatch) -> None:
     """ venv_get_exe on linux """
-    venvauto.IS_WINDOWS = False
+    monkeypatch.setattr(venvauto, 'IS_WINDOWS', False)
     assert str(venvauto.venv_get_exe()) == str(venvauto.venv_dir / 'bin' / 'python')
 
 
-def test_venv_get_exe_windows(venvauto) -> None:
+def test_venv_get_exe_windows(venvauto, monkeypatch) -> None:
     """ venv_get_exe on windows """
-    venvauto.IS_WINDOWS = True
+    monkeypatch.setattr(venvauto, 'IS_WINDOWS', True)
     assert str(venvauto.venv_get_exe()) == str(venvauto.venv_dir / 'Scripts' / 'python.exe')
 
 
@@ -117,9 +269,9 @@ def test_venv_hash_readlines_nofile(venvauto) -> None:
     assert venvauto.venv_hash_readlines() == []
 
 
-def test_venv_hash_readlines_file(venvauto) -> None:
+def test_venv_hash_readlines_file(venvauto, monkeypatch) -> None:
     """ venv_hash_readlines with a file """
-    venvauto.venv_hash_file = SAMPLE_HASH_FILE
+    monkeypatch.setattr(venvauto, 'venv_hash_file', paths().sample_hash_file)
     assert venvauto.venv_hash_readlines() == ['foo:bar', 'hello:world']
 
 
@@ -128,59 +280,140 @@ def test_venv_hash_parse_nofile(venvauto) -> None:
     assert venvauto.venv_hash_parse() == {}
 
 
-def test_venv_hash_parse_file(venvauto) -> None:
+def test_venv_hash_parse_file(venvauto, monkeypatch) -> None:
     """ venv_hash_parse with a file """
-    venvauto.venv_hash_file = SAMPLE_HASH_FILE
+    monkeypatch.setattr(venvauto, 'venv_hash_file', paths().sample_hash_file)
     assert venvauto.venv_hash_parse() == {'foo': 'bar', 'hello': 'world'}
 
 
-def test_venv_create_skipped(venvauto) -> None:
-    """ venv_create but skipped """
-    venvauto.venv_dir.mkdir()
-    venvauto.venv_create()
+def test_venv_hash_write(venvauto, monkeypatch, tmp_path) -> None:
+    """ venv_hash_write """
+    monkeypatch.setattr(venvauto, 'venv_hash_file', tmp_path / 'hash.req.txt')
+    monkeypatch.setattr(venvauto, 'venv_hash', {'foo': 'bar', 'hello': 'world'})
 
+    venvauto.venv_hash_write()
+    assert venvauto.venv_hash_parse() == {'foo': 'bar', 'hello': 'world'}
 
-def expect_run_pip_install(venvauto, fake_process, cmd_args: list) -> None:
-    """ Expect a subprocess call to run a pip install command. """
-    fake_process.register_subprocess(
-        [str(venvauto.venv_get_exe()), '-m', 'pip', 'install'] + cmd_args,
-    )
 
+def test_venv_hash_write_concurrent(venvauto, monkeypatch, tmp_path) -> None:
+    """ venv_hash_write from two writers sharing the same venv """
+    monkeypatch.setattr(venvauto, 'venv_hash_file', tmp_path / 'hash.req.txt')
+    writers = [copy(venvauto) for _ in range(2)]
+    errors: list[BaseException] = []
 
-def expect_run_pip_download_self(venvauto, fake_process) -> None:
-    """ Expect a subprocess call to run pip download for this package, and touch fake file. """
-    fake_process.register_subprocess(
-        [str(venvauto.venv_get_exe()), '-m', 'pip', 'download', venvauto.PACKAGE_NAME],
-    )
+    def write(writer: TestVenvAutouse, value: str) -> None:
+        try:
+            for index in range(200):
+                writer.venv_hash = {'foo': f'{value}{index}'}
+                writer.venv_hash_write()
+        except BaseException as exc:  # pylint: disable=[broad-exception-caught]
+            errors.append(exc)
 
-    touch(venvauto.fake_package)
+    threads = [Thread(target=write, args=(writer, value)) for writer, value in zip(writers, ['bar', 'baz'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
+    assert not errors
+    assert venvauto.venv_hash_parse() in ({'foo': 'bar199'}, {'foo': 'baz199'})
+    # No temporary file left behind
+    assert list(tmp_path.iterdir()) == [venvauto.venv_hash_file]
 
-def expect_run_pip_install_self(venvauto, fake_process) -> None:
-    """ Expect a subprocess call to run pip install for this package. """
-    expect_run_pip_install(venvauto, fake_process, [str(venvauto.fake_package)])
 
+def test_venv_hash_write_unchanged(venvauto, monkeypatch, tmp_path) -> None:
+    """ venv_hash_write with nothing changed """
+    monkeypatch.setattr(venvauto, 'venv_hash_file', tmp_path / 'hash.req.txt')
+    venvauto.venv_hash_file.write_text(paths().sample_hash_file.read_text())
+    inode = venvauto.venv_hash_file.stat().st_ino
 
-def expect_run_ensurepip(venvauto, fake_process) -> None:
-    """ Expect a subprcess call to init venv with pip. """
-    m_flag = '-m'
+    monkeypatch.setattr(venvauto, 'venv_hash', {'foo': 'bar', 'hello': 'world'})
+    venvauto.venv_hash_write()
 
-    if sys.version_info.minor < 10:
-        m_flag = '-Im'
+    # Not replaced
+    assert venvauto.venv_hash_file.stat().st_ino == inode
 
-    fake_process.register_subprocess(
-        [str(venvauto.venv_get_exe()), m_flag, 'ensurepip', '--upgrade', '--default-pip'],
+
+def test_venv_create_skipped(venvauto) -> None:
+    """ venv_create but skipped """
+    venvauto.venv_dir.mkdir()
+    venvauto.venv_create()
+
+
+@pytest.fixture(scope='session')
+def venv_exe(venvauto_proto) -> str:
+    """
+    Test fixture to compute the venv executable of the shared instance only once for the session.
+    """
+    return str(venvauto_proto.venv_get_exe())
+
+
+@pytest.fixture
+def registered(venvauto, fake_process, venv_exe) -> SimpleNamespace:
+    """
+    Test fixture to register the expected subprocess calls.
+    """
+    def pip_install(cmd_args: list) -> None:
+        """ Expect a subprocess call to run a pip install command. """
+        fake_process.register_subprocess((venv_exe,) + PIP_INSTALL_PREFIX + tuple(cmd_args))
+
+    def pip_install_files(filenames: list[Path], packages: list[Path] | None = None) -> None:
+        """ Expect a subprocess call to run a pip install with several files (and packages) command. """
+        cmd_args: list = [str(package) for package in packages or []]
+        for filename in filenames:
+            cmd_args += ['-r', str(filename)]
+
+        pip_install(cmd_args)
+
+    def pip_install_file(filename: Path) -> None:
+        """ Expect a subprocess call to run a pip install with file command. """
+        pip_install_files([filename])
+
+    def pip_install_self() -> None:
+        """ Expect a subprocess call to run pip install for this package. """
+        pip_install([str(venvauto.fake_package)])
+
+    def pip_download_self() -> None:
+        """ Expect a subprocess call to run pip download for this package, and touch fake file. """
+        fake_process.register_subprocess((venv_exe,) + PIP_DOWNLOAD_PREFIX + (venvauto.PACKAGE_NAME,))
+
+        touch(venvauto.fake_package)
+
+    def ensurepip() -> None:
+        """ Expect a subprcess call to init venv with pip. """
+        fake_process.register_subprocess((venv_exe,) + ENSUREPIP_ARGS)
+
+    def venv_create() -> None:
+        """ Expect everything we do when calling venv_create. """
+        ensurepip()
+
+    return SimpleNamespace(
+        pip_install=pip_install,
+        pip_install_files=pip_install_files,
+        pip_install_file=pip_install_file,
+        pip_install_self=pip_install_self,
+        pip_download_self=pip_download_self,
+        ensurepip=ensurepip,
+        venv_create=venv_create,
     )
 
 
-def expect_venv_create(venvauto, fake_process) -> None:
-    """ Expect everything we do when calling venv_create. """
-    expect_run_ensurepip(venvauto, fake_process)
+@pytest.fixture
+def pip_sandbox(fake_process, venv_exe):
+    """
+    Test fixture to accept any pip call, for the tests which only check the final state.
+
+    The exact pip commands are checked by the tests of the run_pip_* methods.
+    """
+    fake_process.register([venv_exe, '-m', 'pip', fake_process.any()])
+    fake_process.keep_last_process(True)
 
+    return fake_process
 
-def test_venv_create_do(venvauto, fake_process) -> None:
+
+def test_venv_create_do(venvauto, registered) -> None:
     """ venv_create for real """
-    expect_venv_create(venvauto, fake_process)
+    registered.venv_create()
 
     venvauto.venv_create()
     assert venvauto.venv_dir.exists()
@@ -188,30 +421,37 @@ def test_venv_create_do(venvauto, fake_process) -> None:
 
 def test_venv_hash_check_nofile(venvauto) -> None:
     """ venv_hash_check with no file """
-    assert not venvauto.venv_hash_check(FOO_FILE)
+    assert not venvauto.venv_hash_check(paths().foo_file)
+
+
+def test_venv_hash_check_empty_hash(venvauto, monkeypatch) -> None:
+    """ venv_hash_check with an empty stored hash does not digest the file """
+    monkeypatch.setattr(venvauto, 'venv_hash', {paths().foo_file.name: ''})
+    assert not venvauto.venv_hash_check(paths().foo_file)
+    assert paths().foo_file not in venvauto.req_files
 
 
-def test_venv_hash_check_wrong_hash(venvauto) -> None:
+def test_venv_hash_check_wrong_hash(venvauto, monkeypatch) -> None:
     """ venv_hash_check with a file having the wrong hash """
-    venvauto.venv_hash = {SAMPLE_REQ_FILE.name: SAMPLE_REQ_FILE_HASH + 'foo'}
-    assert not venvauto.venv_hash_check(SAMPLE_REQ_FILE)
+    monkeypatch.setattr(venvauto, 'venv_hash', {paths().sample_req_file.name: paths().sample_req_file_hash + 'foo'})
+    assert not venvauto.venv_hash_check(paths().sample_req_file)
 
 
-def test_venv_hash_check_match(venvauto) -> None:
+def test_venv_hash_check_match(venvauto, monkeypatch) -> None:
     """ venv_hash_check with the file matching the hash """
-    venvauto.venv_hash = {SAMPLE_REQ_FILE.name: SAMPLE_REQ_FILE_HASH}
-    assert venvauto.venv_hash_check(SAMPLE_REQ_FILE)
+    monkeypatch.setattr(venvauto, 'venv_hash', {paths().sample_req_file.name: paths().sample_req_file_hash})
+    assert venvauto.venv_hash_check(paths().sample_req_file)
 
 
-def test_venv_install_self_file_downloaded(venvauto, fake_process) -> None:
+def test_venv_install_self_file_downloaded(venvauto, registered, fs) -> None:
     """ venv_install_self but wheel file is already downloaded """
-    touch(venvauto.fake_package)
-    expect_run_pip_install_self(venvauto, fake_process)
+    fs.create_file(venvauto.fake_package)
+    registered.pip_install_self()
 
     venvauto.venv_install_self()
 
 
-def test_venv_install_self_file_installed(venvauto, fake_process) -> None:
+def test_venv_install_self_file_installed(venvauto, fake_process, fs) -> None:
     """ venv_install_self but wheel file is already installed """
     wheel = venvauto.venv_dir / (venvauto.PACKAGE_NAME + '-py3-none-any.whl')
 
@@ -223,117 +463,132 @@ def test_venv_install_self_file_installed(venvauto, fake_process) -> None:
         / (venvauto.PACKAGE_NAME + '.dist-info')
     )
 
-    touch(wheel)
-    touch(dist_info)
+    fs.create_file(wheel)
+    fs.create_dir(dist_info)
 
     venvauto.venv_install_self()
 
 
-def test_venv_install_self_nofile(venvauto, fake_process) -> None:
+def test_venv_find_self_install_installed(venvauto, fake_process, fs) -> None:
+    """ venv_find_self_install but wheel file is already installed """
+    wheel = venvauto.venv_dir / (venvauto.PACKAGE_NAME + '-py3-none-any.whl')
+    fs.create_file(wheel)
+    fs.create_dir(
+        venvauto.venv_dir / 'lib' / 'python3' / 'site-packages' / (venvauto.PACKAGE_NAME + '.dist-info')
+    )
+
+    assert venvauto.venv_find_self_install() is None
+
+
+def test_venv_find_self_install_downloaded(venvauto, fake_process, fs) -> None:
+    """ venv_find_self_install but wheel file is only downloaded """
+    fs.create_file(venvauto.fake_package)
+
+    assert venvauto.venv_find_self_install() == venvauto.fake_package
+
+
+def test_venv_install_self_nofile(venvauto, registered, fs) -> None:
     """ venv_install_self but needs to download and install file """
-    expect_run_pip_download_self(venvauto, fake_process)
-    expect_run_pip_install_self(venvauto, fake_process)
+    registered.pip_download_self()
+    registered.pip_install_self()
 
     venvauto.venv_install_self()
 
 
-def expect_run_pip_install_file(venvauto, fake_process, filename: Path) -> None:
-    """ Expect a subprocess call to run a pip install with file command. """
-    expect_run_pip_install(venvauto, fake_process, ['-r', str(filename)])
+def test_run_pip_install_file(venvauto, registered) -> None:
+    """ run_pip_install_file """
+    registered.pip_install_file(paths().foo_file)
+    venvauto.run_pip_install_file(paths().foo_file)
 
 
-def test_run_pip_install_file(venvauto, fake_process) -> None:
-    """ run_pip_install_file """
-    expect_run_pip_install_file(venvauto, fake_process, FOO_FILE)
-    venvauto.run_pip_install_file(FOO_FILE)
+def test_run_pip_install_files(venvauto, registered) -> None:
+    """ run_pip_install_files """
+    registered.pip_install_files([paths().sample_req_file, paths().sample_req_file2])
+    venvauto.run_pip_install_files([paths().sample_req_file, paths().sample_req_file2])
 
 
-def test_venv_apply_req_file_nofile(venvauto, fake_process) -> None:
+def test_venv_apply_req_file_nofile(venvauto, pip_sandbox) -> None:
     """ venv_apply_req_file with no req file """
-    expect_run_pip_install_file(venvauto, fake_process, FOO_FILE)
-    venvauto.venv_apply_req_file(FOO_FILE)
-    assert FOO_FILE.name not in venvauto.venv_hash
+    venvauto.venv_apply_req_file(paths().foo_file)
+    assert paths().foo_file.name not in venvauto.venv_hash
+    assert len(pip_sandbox.calls) == 0
 
 
-def test_venv_apply_req_file_exist_not_digested(venvauto, fake_process) -> None:
+def test_venv_apply_req_file_exist_not_digested(venvauto, pip_sandbox) -> None:
     """ venv_apply_req_file with a real req file not digested """
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE)
-    venvauto.venv_apply_req_file(SAMPLE_REQ_FILE)
-    assert SAMPLE_REQ_FILE.name in venvauto.venv_hash
-    assert venvauto.venv_hash[SAMPLE_REQ_FILE.name] == SAMPLE_REQ_FILE_HASH
+    venvauto.venv_apply_req_file(paths().sample_req_file)
+    assert paths().sample_req_file.name in venvauto.venv_hash
+    assert venvauto.venv_hash[paths().sample_req_file.name] == paths().sample_req_file_hash
+    assert [list(call)[-2:] for call in pip_sandbox.calls] == [['-r', str(paths().sample_req_file)]]
 
 
-def test_venv_apply_req_file_exist_digested(venvauto, fake_process) -> None:
+def test_venv_apply_req_file_exist_digested(venvauto, pip_sandbox) -> None:
     """ venv_apply_req_file with a real req file already digested """
-    venvauto.req_files[SAMPLE_REQ_FILE] = SAMPLE_REQ_FILE_HASH
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE)
+    venvauto.req_files[paths().sample_req_file] = paths().sample_req_file_hash
 
-    venvauto.venv_apply_req_file(SAMPLE_REQ_FILE)
+    venvauto.venv_apply_req_file(paths().sample_req_file)
 
-    assert SAMPLE_REQ_FILE.name in venvauto.venv_hash
-    assert venvauto.venv_hash[SAMPLE_REQ_FILE.name] == SAMPLE_REQ_FILE_HASH
+    assert paths().sample_req_file.name in venvauto.venv_hash
+    assert venvauto.venv_hash[paths().sample_req_file.name] == paths().sample_req_file_hash
+    assert [list(call)[-2:] for call in pip_sandbox.calls] == [['-r', str(paths().sample_req_file)]]
 
 
 def test_venv_apply_req_file_exist_digested_and_match(venvauto, fake_process) -> None:
     """ venv_apply_req_file with a real req file already digested and matching """
-    venvauto.req_files[SAMPLE_REQ_FILE] = SAMPLE_REQ_FILE_HASH
-    venvauto.venv_hash[SAMPLE_REQ_FILE.name] = SAMPLE_REQ_FILE_HASH
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE)
+    venvauto.req_files[paths().sample_req_file] = paths().sample_req_file_hash
+    venvauto.venv_hash[paths().sample_req_file.name] = paths().sample_req_file_hash
 
-    venvauto.venv_apply_req_file(SAMPLE_REQ_FILE)
+    # Nothing is registered, pip must not be called
+    assert not venvauto.venv_apply_req_file(paths().sample_req_file)
+    assert len(fake_process.calls) == 0
 
-    assert SAMPLE_REQ_FILE.name in venvauto.venv_hash
-    assert venvauto.venv_hash[SAMPLE_REQ_FILE.name] == SAMPLE_REQ_FILE_HASH
+    assert paths().sample_req_file.name in venvauto.venv_hash
+    assert venvauto.venv_hash[paths().sample_req_file.name] == paths().sample_req_file_hash
 
 
-def test_venv_update_nofile(venvauto, fake_process) -> None:
+def test_venv_update_nofile(venvauto, registered, fs) -> None:
     """ venv_update with no req file available """
-    venvauto.venv_dir.mkdir()
-    touch(venvauto.fake_package)
-    expect_run_pip_install_self(venvauto, fake_process)
+    fs.create_dir(venvauto.venv_dir)
+    fs.create_file(venvauto.fake_package)
+    registered.pip_install_self()
     assert not venvauto.venv_update()
 
 
-def test_venv_update_one_file(venvauto, fake_process) -> None:
+def test_venv_update_one_file(venvauto, registered, monkeypatch, tmp_path) -> None:
     """ venv_update with one req file available """
-    venvauto.venv_hash_file = Path(__file__).parent / 'tmp_venv_hash_file_one_file.txt'
-    venvauto.dir_req_filename = SAMPLE_REQ_FILE
+    monkeypatch.setattr(venvauto, 'venv_hash_file', tmp_path / 'hash.req.txt')
+    monkeypatch.setattr(venvauto, 'dir_req_filename', paths().sample_req_file)
 
-    expect_venv_create(venvauto, fake_process)
+    registered.venv_create()
     touch(venvauto.fake_package)
-    expect_run_pip_install_self(venvauto, fake_process)
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE)
+    registered.pip_install_files([paths().sample_req_file], [venvauto.fake_package])
     venvauto.venv_update()
 
-    assert venvauto.venv_hash_parse() == {SAMPLE_REQ_FILE.name: SAMPLE_REQ_FILE_HASH}
+    assert venvauto.venv_hash_parse() == {paths().sample_req_file.name: paths().sample_req_file_hash}
 
 
-def test_venv_update_two_files(venvauto, fake_process) -> None:
+def test_venv_update_two_files(venvauto, registered, monkeypatch, tmp_path) -> None:
     """ venv_update with two req files available """
-    venvauto.venv_hash_file = Path(__file__).parent / 'tmp_venv_hash_file_two_files.txt'
-    venvauto.dir_req_filename = SAMPLE_REQ_FILE
-    venvauto.file_req_filename = SAMPLE_REQ_FILE2
+    monkeypatch.setattr(venvauto, 'venv_hash_file', tmp_path / 'hash.req.txt')
+    monkeypatch.setattr(venvauto, 'dir_req_filename', paths().sample_req_file)
+    monkeypatch.setattr(venvauto, 'file_req_filename', paths().sample_req_file2)
 
-    expect_venv_create(venvauto, fake_process)
+    registered.venv_create()
     touch(venvauto.fake_package)
-    expect_run_pip_install_self(venvauto, fake_process)
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE)
-    expect_run_pip_install_file(venvauto, fake_process, SAMPLE_REQ_FILE2)
+    registered.pip_install_files([paths().sample_req_file, paths().sample_req_file2], [venvauto.fake_package])
     venvauto.venv_update()
 
     assert venvauto.venv_hash_parse() == {
-        SAMPLE_REQ_FILE.name: SAMPLE_REQ_FILE_HASH,
-        SAMPLE_REQ_FILE2.name: '7268a6b8e8450e70926eab67446285299a91b3672b5cc58847cd0ac0b9b415ef',
+        paths().sample_req_file.name: paths().sample_req_file_hash,
+        paths().sample_req_file2.name: paths().sample_req_file2_hash,
     }
 
 
-def test_execute_env_var(venvauto, fake_process) -> None:
+def test_execute_env_var(venvauto, fake_process, monkeypatch) -> None:
     """ execute skipped due to env var """
-    environ['PYTHON_VENV_AUTOUSE_SUBPROCESS'] = '1'
+    monkeypatch.setenv('PYTHON_VENV_AUTOUSE_SUBPROCESS', '1')
     venvauto.execute()
 
-    del environ['PYTHON_VENV_AUTOUSE_SUBPROCESS']
-
 
 def test_execute_no_req_file(venvauto, fake_process) -> None:
     """ execute with no req file """
@@ -341,31 +596,35 @@ def test_execute_no_req_file(venvauto, fake_process) -> None:
     venvauto.execute()
 
 
-def test_execute_return(venvauto, fake_process) -> None:
+def test_execute_return(venvauto, fake_process, monkeypatch) -> None:
     """ execute with venv not updated """
     # Cheat so we beleive we are in venv
-    venvauto.venv_dir = Path(sys.prefix)
+    monkeypatch.setattr(venvauto, 'venv_dir', Path(sys.prefix))
     fake_package = venvauto.venv_dir / venvauto.PACKAGE_NAME
 
-    venvauto.req_files = {key: 'foo' for key in venvauto.req_files}
+    monkeypatch.setattr(venvauto, 'req_files', {key: 'foo' for key in venvauto.req_files})
+    # Requirements already installed
+    monkeypatch.setattr(venvauto, 'venv_hash', {key.name: 'foo' for key in venvauto.req_files})
 
-    expect_run_pip_download_self(venvauto, fake_process)
+    # Not using the registered fixture, the venv executable changed
+    exe = str(venvauto.venv_get_exe())
+    fake_process.register_subprocess((exe,) + PIP_DOWNLOAD_PREFIX + (venvauto.PACKAGE_NAME,))
     touch(fake_package)
-    expect_run_pip_install(venvauto, fake_process, [str(fake_package)])
+    fake_process.register_subprocess((exe,) + PIP_INSTALL_PREFIX + (str(fake_package),))
 
     venvauto.execute()
 
-    venvauto.venv_dir = None  # prevent fixture to do teardown
-
 
-def test_execute_subprocess(venvauto, fake_process) -> None:
+def test_execute_subprocess(venvauto, fake_process, registered, venv_exe, fs, monkeypatch) -> None:
     """ execute with venv update """
-    venvauto.req_files = {key: 'foo' for key in venvauto.req_files}
-    venvauto.venv_dir.mkdir()
-    touch(venvauto.fake_package)
-    expect_run_pip_install(venvauto, fake_process, [str(venvauto.fake_package)])
-
-    fake_process.register_subprocess([str(venvauto.venv_get_exe())] + sys.argv)
+    monkeypatch.setattr(venvauto, 'req_files', {key: 'foo' for key in venvauto.req_files})
+    # Requirements already installed
+    monkeypatch.setattr(venvauto, 'venv_hash', {key.name: 'foo' for key in venvauto.req_files})
+    fs.create_dir(venvauto.venv_dir)
+    fs.create_file(venvauto.fake_package)
+    registered.pip_install_self()
+
+    fake_process.register_subprocess([venv_exe] + sys.argv)
 
     with pytest.raises(SystemExit) as sys_exit:
         venvauto.execute()
@@ -3,8 +3,11 @@
 Tests for "file.py".
 """
 from pathlib import Path
-from subprocess import run
 from os import environ
+import runpy
+
+# pylint: disable=[import-error]
+import pytest  # type: ignore
 
 
 # Cheat package to not execute
@@ -21,8 +24,9 @@ def test_execute_file() -> None:
     """ Test executing the file raises an exception. """
     root_dir = Path(__file__).resolve().parents[2]
     venv_autouse_file = root_dir / 'src' / 'venv_autouse' / 'file.py'
-    process = run([venv_autouse_file], check=False)
-    assert process.returncode != 0
+    # The module cannot even be loaded outside of its package
+    with pytest.raises(ImportError):
+        runpy.run_path(str(venv_autouse_file), run_name='__main__')
 
 
 def test_venv_dir_prefix() -> None: